@@ -209,7 +209,6 @@ class Estimator():
 
         # change brightness of the observed image
         if self.delta_brightness != 0:
-            obs_img = (np.array(obs_img) / 255.).astype(np.float32)
             obs_img = cv2.cvtColor(obs_img, cv2.COLOR_RGB2HSV)
             if self.delta_brightness < 0:
                 obs_img[..., 2][obs_img[..., 2] < abs(self.delta_brightness)] = 0.
@@ -312,7 +311,7 @@ class Estimator():
                     rand_inds = np.random.choice(POI.shape[0], size=self.batch_size, replace=False)
                     batch = POI[rand_inds]
                 else:
-                    batch = np.zeros((self.batch_size, 2), dtype=np.int)
+                    batch = np.zeros((self.batch_size, 2), dtype=int)
                     batch[:POI.shape[0]] = POI
                     rand_inds = np.random.choice(not_POI.shape[0], size=self.batch_size-POI.shape[0], replace=False)
                     batch[POI.shape[0]:] = not_POI[rand_inds]
@@ -1,12 +1,23 @@
+import inspect
+import math
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import cv2
-import skimage
 import matplotlib.pyplot as plt
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# single fused kernel for the Adam update on cuda (torch >= 2.0), multi-tensor path otherwise (torch >= 1.12)
+adam_args = inspect.signature(torch.optim.Adam).parameters
+if device.type == 'cuda' and 'fused' in adam_args:
+    adam_impl = {'fused': True}
+elif 'foreach' in adam_args:
+    adam_impl = {'foreach': True}
+else:
+    adam_impl = {}
+
 #Helper Functions
 def find_POI(img_rgb, DEBUG=False): # img - RGB image in range 0...255
     img = np.copy(img_rgb)
@@ -14,34 +25,58 @@ def find_POI(img_rgb, DEBUG=False): # img - RGB image in range 0...255
     sift = cv2.SIFT_create()
     keypoints = sift.detect(img_gray, None)
     xy = [keypoint.pt for keypoint in keypoints]
-    xy = np.array(xy).astype(int)
+    xy = np.array(xy).astype(np.int32)
     # Remove duplicate points
-    xy_set = set(tuple(point) for point in xy)
-    xy = np.array([list(point) for point in xy_set]).astype(int)
+    xy = np.unique(xy, axis=0)
     return xy # pixel coordinates
 
-img2mse = lambda x, y : torch.mean((x - y) ** 2)
-
-def vec2ss_matrix(vector):  # vector to skewsym. matrix
-
-    ss_matrix = torch.zeros((3,3))
-    ss_matrix[0, 1] = -vector[2]
-    ss_matrix[0, 2] = vector[1]
-    ss_matrix[1, 0] = vector[2]
-    ss_matrix[1, 2] = -vector[0]
-    ss_matrix[2, 0] = -vector[1]
-    ss_matrix[2, 1] = vector[0]
+def find_POI_harris(img_rgb, k=0.04, threshold=0.01, nms_size=3): # img - (H, W, 3) RGB tensor in range 0...1
+    # Harris corner response computed with convolutions, so the points stay on the image's device
+    gray = (img_rgb @ torch.tensor([0.299, 0.587, 0.114], device=img_rgb.device))[None, None]
+    sobel_x = torch.tensor([[-1., 0., 1.], [-2., 0., 2.], [-1., 0., 1.]], device=img_rgb.device)[None, None] / 8
+    # reflect the borders like cv2.cornerHarris (BORDER_REFLECT_101), zero padding turns the image edges into steps
+    gray = F.pad(gray, (1, 1, 1, 1), mode='reflect')
+    I_x = F.conv2d(gray, sobel_x)
+    I_y = F.conv2d(gray, sobel_x.transpose(-1, -2))
+
+    # structure tensor summed over a 3x3 window, with the same border handling
+    products = F.pad(torch.cat([I_x * I_x, I_y * I_y, I_x * I_y], dim=1), (1, 1, 1, 1), mode='reflect')
+    I_xx, I_yy, I_xy = F.avg_pool2d(products, 3, stride=1).split(1, dim=1)
+    response = I_xx * I_yy - I_xy ** 2 - k * (I_xx + I_yy) ** 2
+
+    # non-maximum suppression, keep strong local maxima only
+    # (without a positive response the relative threshold would keep every local maximum of a flat image)
+    max_response = response.max()
+    local_max = response == F.max_pool2d(response, nms_size, stride=1, padding=nms_size // 2)
+    corners = local_max & (response > threshold * max_response) & (max_response > 0)
+    return corners[0, 0].nonzero()[:, [1, 0]] # xy pixel coordinates
 
-    return ss_matrix
+img2mse = lambda x, y : torch.mean((x - y) ** 2)
+if hasattr(torch, "compile"):
+    # inductor folds the elementwise difference and square into the mean reduction
+    img2mse = torch.compile(img2mse)
 
 
 class camera_transf(nn.Module):
     def __init__(self):
         super(camera_transf, self).__init__()
-        self.psi = nn.Parameter(torch.normal(0., 1e-4, size=(1,)))
-        self.phi = nn.Parameter(torch.normal(0., 1e-4, size=(1,)))
-        self.v = nn.Parameter(torch.normal(0., 1e-5, size=(3,)))
-        self.theta = nn.Parameter(torch.normal(0., 1e-4, size=(1,)))
+        self.psi = nn.Parameter(torch.empty(1))
+        self.phi = nn.Parameter(torch.empty(1))
+        self.v = nn.Parameter(torch.empty(3))
+        self.theta = nn.Parameter(torch.empty(1))
+        self.reset_parameters()
+
+        # constants of the exponential map, buffers so that they follow the module's device
+        self.register_buffer('I3', torch.eye(3))
+        self.register_buffer('last_row', torch.tensor([[0., 0., 0., 1.]]))
+
+    def reset_parameters(self):
+        # in-place, so that the optimizer keeps referencing the same parameters
+        with torch.no_grad():
+            self.psi.normal_(0., 1e-4)
+            self.phi.normal_(0., 1e-4)
+            self.v.normal_(0., 1e-5)
+            self.theta.normal_(0., 1e-4)
 
     def forward(self, x):
         #print('Starting pose', x)
@@ -54,19 +89,24 @@ class camera_transf(nn.Module):
         #convert w to spherical
         w = torch.cat((torch.cos(psi)*torch.sin(phi), torch.sin(psi)*torch.sin(phi), torch.cos(phi)))
 
-        exp_i = torch.zeros((4,4))
-        w_skewsym = vec2ss_matrix(w)
+        # skew-symmetric matrix of w, built on w's device
+        zero = torch.zeros((), device=w.device)
+        w_skewsym = torch.stack([torch.stack([zero, -w[2], w[1]]),
+                                 torch.stack([w[2], zero, -w[0]]),
+                                 torch.stack([-w[1], w[0], zero])])
+        w_skewsym_sq = torch.matmul(w_skewsym, w_skewsym)
 
-        exp_i[:3, :3] = torch.eye(3) + torch.sin(theta) * w_skewsym + (1 - torch.cos(theta)) * torch.matmul(w_skewsym, w_skewsym)
-        exp_i[:3, 3] = self.v #torch.matmul(torch.eye(3) * theta + (1 - torch.cos(theta)) * w_skewsym + (theta - torch.sin(theta)) * torch.matmul(w_skewsym, w_skewsym), self.v)
-        exp_i[3, 3] = 1.
+        # Rodrigues' formula
+        rot = self.I3 + torch.sin(theta) * w_skewsym + (1 - torch.cos(theta)) * w_skewsym_sq
+        trans = self.v[:, None] #torch.matmul(self.I3 * theta + (1 - torch.cos(theta)) * w_skewsym + (theta - torch.sin(theta)) * w_skewsym_sq, self.v)
+        exp_i = torch.cat((torch.cat((rot, trans), dim=1), self.last_row), dim=0)
 
         T_i = torch.matmul(exp_i, x)
         #T_i = torch.matmul(x, exp_i)
         return T_i
 
 class Estimator():
-    def __init__(self, N_iter, batch_size, sampling_strategy, renderer, dil_iter=3, kernel_size=5, lrate=.01, noise=None, sigma=0.01, amount=0.8, delta_brightness=0.) -> None:
+    def __init__(self, N_iter, batch_size, sampling_strategy, renderer, dil_iter=3, kernel_size=5, lrate=.01, noise=None, sigma=0.01, amount=0.8, delta_brightness=0., poi_detector='sift') -> None:
     # Parameters
         self.batch_size = batch_size
         self.kernel_size = kernel_size
@@ -77,6 +117,10 @@ class Estimator():
         #delta_phi, delta_theta, delta_psi, delta_t = args.delta_phi, args.delta_theta, args.delta_psi, args.delta_t
         self.noise, self.sigma, self.amount = noise, sigma, amount
         self.delta_brightness = delta_brightness
+        # 'sift' (OpenCV, on the host) or 'harris' (torch, on the device)
+        if poi_detector not in ['sift', 'harris']:
+            raise ValueError(f"Unknown POI detector '{poi_detector}', expected 'sift' or 'harris'")
+        self.poi_detector = poi_detector
 
         self.renderer = renderer
 
@@ -85,67 +129,86 @@ class Estimator():
         # create meshgrid from the observed image
         self.W, self.H, self.focal = self.renderer.hwf
         self.coords = np.asarray(np.stack(np.meshgrid(np.linspace(0, self.W - 1, self.W), np.linspace(0, self.H - 1, self.H)), -1),
-                            dtype=int)
+                            dtype=np.int32)
+        # flattened (H*W, 2) copy on the device, sampled from without going through NumPy
+        self.coords_gpu = torch.from_numpy(self.coords.reshape(self.H * self.W, 2)).to(device=device, dtype=torch.long)
 
     def estimate_pose(self, start_pose, obs_img, obs_img_pose):
 
-        obs_img = (np.array(obs_img) / 255.).astype(np.float32)
+        obs_img = torch.from_numpy((np.array(obs_img) / 255.).astype(np.float32)).to(device)
 
         # change brightness of the observed image
         if self.delta_brightness != 0:
-            obs_img = (np.array(obs_img) / 255.).astype(np.float32)
-            obs_img = cv2.cvtColor(obs_img, cv2.COLOR_RGB2HSV)
+            # only the HSV value (max over RGB) changes, hue and saturation are kept by scaling RGB with it
+            value = obs_img.max(dim=-1, keepdim=True)[0]
             if self.delta_brightness < 0:
-                obs_img[..., 2][obs_img[..., 2] < abs(self.delta_brightness)] = 0.
-                obs_img[..., 2][obs_img[..., 2] >= abs(self.delta_brightness)] += self.delta_brightness
+                new_value = torch.where(value < abs(self.delta_brightness), torch.zeros_like(value), value + self.delta_brightness)
             else:
                 lim = 1. - self.delta_brightness
-                obs_img[..., 2][obs_img[..., 2] > lim] = 1.
-                obs_img[..., 2][obs_img[..., 2] <= lim] += self.delta_brightness
-            obs_img = cv2.cvtColor(obs_img, cv2.COLOR_HSV2RGB)
+                new_value = torch.where(value > lim, torch.ones_like(value), value + self.delta_brightness)
+            obs_img = torch.where(value > 0, obs_img * new_value / value, new_value.expand_as(obs_img))
 
-        # apply noise to the observed image
+        # apply noise to the observed image (same models as skimage.util.random_noise)
         if self.noise == 'gaussian':
-            obs_img_noised = skimage.util.random_noise(obs_img, mode='gaussian', var=self.sigma**2)
-        elif self.noise == 's_and_p':
-            obs_img_noised = skimage.util.random_noise(obs_img, mode='s&p', amount=self.amount)
-        elif self.noise == 'pepper':
-            obs_img_noised = skimage.util.random_noise(obs_img, mode='pepper', amount=self.amount)
-        elif self.noise == 'salt':
-            obs_img_noised = skimage.util.random_noise(obs_img, mode='salt', amount=self.amount)
+            obs_img_noised = (obs_img + self.sigma * torch.randn_like(obs_img)).clamp(0., 1.)
+        elif self.noise in ['s_and_p', 'pepper', 'salt']:
+            flipped = torch.rand_like(obs_img) < self.amount
+            if self.noise == 's_and_p':
+                salt = (torch.rand_like(obs_img) < 0.5).float()
+            else:
+                salt = float(self.noise == 'salt')
+            obs_img_noised = torch.where(flipped, salt, obs_img)
         elif self.noise == 'poisson':
-            obs_img_noised = skimage.util.random_noise(obs_img, mode='poisson')
+            vals = 2 ** math.ceil(math.log2(torch.unique(obs_img).numel()))
+            obs_img_noised = (torch.poisson(obs_img * vals) / vals).clamp(0., 1.)
         else:
             obs_img_noised = obs_img
 
-        obs_img_noised = (np.array(obs_img_noised) * 255).astype(np.uint8)
+        obs_img_noised = (obs_img_noised * 255).to(torch.uint8)
 
-        if self.sampling_strategy == 'interest_regions':
+        if self.sampling_strategy == 'interest_regions' and self.poi_detector == 'sift':
             # find points of interest of the observed image
-            POI = find_POI(obs_img_noised, False)  # xy pixel coordinates of points of interest (N x 2)
+            POI = find_POI(obs_img_noised.cpu().numpy(), False)  # xy pixel coordinates of points of interest (N x 2)
 
-        obs_img_noised = (np.array(obs_img_noised) / 255.).astype(np.float32)
+        obs_img_gpu = obs_img_noised / 255.
 
         if self.sampling_strategy == 'interest_regions':
-            # create sampling mask for interest region sampling strategy
-            interest_regions = np.zeros((self.H, self.W, ), dtype=np.uint8)
-            interest_regions[POI[:,1], POI[:,0]] = 1
-            I = self.dil_iter
-            interest_regions = cv2.dilate(interest_regions, np.ones((self.kernel_size, self.kernel_size), np.uint8), iterations=I)
-            interest_regions = np.array(interest_regions, dtype=bool)
-            interest_regions = self.coords[interest_regions]
-
-        # not_POI contains all points except of POI
-        coords = self.coords.reshape(self.H * self.W, 2)
+            if self.poi_detector == 'sift':
+                POI_gpu = torch.from_numpy(POI).to(device=device, dtype=torch.long)
+            elif self.poi_detector == 'harris':
+                POI_gpu = find_POI_harris(obs_img_gpu)
 
-        if self.sampling_strategy == 'interest_regions':
-            not_POI = set(tuple(point) for point in coords) - set(tuple(point) for point in POI)
-            not_POI = np.array([list(point) for point in not_POI]).astype(int)
+            POI_mask = torch.zeros((1, 1, self.H, self.W), device=device)
+            POI_mask[0, 0, POI_gpu[:, 1], POI_gpu[:, 0]] = 1
 
-        # Create pose transformation model
-        #start_pose = torch.Tensor(start_pose).to(device)
-        #cam_transf = camera_transf().to(device)
-        #optimizer = torch.optim.Adam(params=cam_transf.parameters(), lr=self.lrate, betas=(0.9, 0.999))
+            # create sampling mask for interest region sampling strategy
+            interest_regions = POI_mask
+            I = self.dil_iter
+            # box dilation on device, equivalent to cv2.dilate with a kernel_size x kernel_size kernel
+            # (an even kernel grows the output by one row/column, cropping keeps cv2's anchor)
+            for _ in range(I):
+                interest_regions = F.max_pool2d(interest_regions, kernel_size=self.kernel_size, stride=1, padding=self.kernel_size // 2)
+                interest_regions = interest_regions[..., :self.H, :self.W]
+            interest_regions = interest_regions[0, 0].nonzero()[:, [1, 0]]  # xy pixel coordinates
+
+        # pixels to sample from, already on the device; batches are drawn there as well
+        if self.sampling_strategy == 'random':
+            sampling_pool = self.coords_gpu
+        elif self.sampling_strategy == 'interest_regions':
+            sampling_pool = interest_regions
+        else:
+            print('Unknown sampling strategy')
+            return
+
+        # draw the indices of all batches up front: each batch is a disjoint chunk of a random
+        # permutation of the pool, so pixels are not repeated within a batch
+        pool_size = sampling_pool.shape[0]
+        if pool_size < self.batch_size:
+            raise ValueError(f'Cannot sample {self.batch_size} pixels from {pool_size} candidates')
+        batches_per_perm = pool_size // self.batch_size
+        num_perms = -(-self.iter // batches_per_perm)
+        batch_inds = torch.cat([torch.randperm(pool_size, device=device)[:batches_per_perm * self.batch_size] for _ in range(num_perms)])
+        batch_inds = batch_inds.view(-1, self.batch_size)
 
         # calculate angles and translation of the observed image's pose
         phi_ref = np.arctan2(obs_img_pose[1,0], obs_img_pose[0,0])*180/np.pi
@@ -153,29 +216,22 @@ class Estimator():
         psi_ref = np.arctan2(obs_img_pose[2, 1], obs_img_pose[2, 2])*180/np.pi
         translation_ref = np.sqrt(obs_img_pose[0,3]**2 + obs_img_pose[1,3]**2 + obs_img_pose[2,3]**2)
 
-        new_lrate = self.lrate
-        best_loss = 1e5
-        best_pose = start_pose
-        for k in range(self.iter):
-
-            start_pose = torch.Tensor(start_pose).to(device)
-            cam_transf = camera_transf().to(device)
-            optimizer = torch.optim.Adam(params=cam_transf.parameters(), lr=new_lrate, betas=(0.9, 0.999))
-
-            if self.sampling_strategy == 'random':
-                rand_inds = np.random.choice(coords.shape[0], size=self.batch_size, replace=False)
-                batch = coords[rand_inds]
+        # Create pose transformation model
+        start_pose = torch.Tensor(start_pose).to(device)
+        cam_transf = camera_transf().to(device)
+        optimizer = torch.optim.Adam(params=cam_transf.parameters(), lr=self.lrate, betas=(0.9, 0.999), **adam_impl)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda k: 0.8 ** (k / 100))
 
-            elif self.sampling_strategy == 'interest_regions':
-                rand_inds = np.random.choice(interest_regions.shape[0], size=self.batch_size, replace=False)
-                batch = interest_regions[rand_inds]
+        best_loss = torch.full((), 1e5, device=device)
+        best_pose = start_pose.clone()
+        for k in range(self.iter):
 
-            else:
-                print('Unknown sampling strategy')
-                return
+            # every step starts from a fresh transformation and optimizer state
+            cam_transf.reset_parameters()
+            optimizer.state.clear()
 
-            target_s = obs_img_noised[batch[:, 1], batch[:, 0]]
-            target_s = torch.Tensor(target_s).to(device)
+            batch = sampling_pool[batch_inds[k]]
+            target_s = obs_img_gpu[batch[:, 1], batch[:, 0]]
             pose = cam_transf(start_pose)
 
             rgb = self.renderer.get_img_from_pix(batch, pose, HW=False)
@@ -185,30 +241,30 @@ class Estimator():
             loss = img2mse(rgb, target_s)
             loss.backward()
             optimizer.step()
+            scheduler.step()
 
-            if loss.cpu().detach().numpy() < best_loss:
-                best_loss = loss.cpu().detach().numpy()
-                best_pose = pose
-
-            start_pose = cam_transf(start_pose)
-            start_pose = start_pose.cpu().detach().numpy()
+            with torch.no_grad():
+                # keep track of the best pose on device to avoid a host sync per step
+                better = loss < best_loss
+                best_loss = torch.where(better, loss, best_loss)
+                best_pose = torch.where(better, pose, best_pose)
 
-            new_lrate = self.lrate * (0.8 ** ((k + 1) / 100))
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = new_lrate
+                start_pose = cam_transf(start_pose)
 
             if (k + 1) % 20 == 0 or k == 0:
-                print('Step: ', k)
-                print('Loss: ', loss)
-
                 with torch.no_grad():
-                    pose_dummy = pose.cpu().detach().numpy()
-                    # calculate angles and translation of the optimized pose
-                    phi = np.arctan2(pose_dummy[1, 0], pose_dummy[0, 0]) * 180 / np.pi
-                    theta = np.arctan2(-pose_dummy[2, 0], np.sqrt(pose_dummy[2, 1] ** 2 + pose_dummy[2, 2] ** 2)) * 180 / np.pi
-                    psi = np.arctan2(pose_dummy[2, 1], pose_dummy[2, 2]) * 180 / np.pi
-                    translation = np.sqrt(pose_dummy[0,3]**2 + pose_dummy[1,3]**2 + pose_dummy[2,3]**2)
+                    pose_dummy = pose.detach()
+                    # calculate angles and translation of the optimized pose on device, then transfer once
+                    phi = torch.atan2(pose_dummy[1, 0], pose_dummy[0, 0]) * 180 / np.pi
+                    theta = torch.atan2(-pose_dummy[2, 0], torch.sqrt(pose_dummy[2, 1] ** 2 + pose_dummy[2, 2] ** 2)) * 180 / np.pi
+                    psi = torch.atan2(pose_dummy[2, 1], pose_dummy[2, 2]) * 180 / np.pi
+                    translation = torch.sqrt(pose_dummy[0,3]**2 + pose_dummy[1,3]**2 + pose_dummy[2,3]**2)
                     #translation = pose_dummy[2, 3]
+                    phi, theta, psi, translation, loss_val = torch.stack([phi, theta, psi, translation, loss.detach()]).cpu().numpy()
+
+                    print('Step: ', k)
+                    print('Loss: ', loss_val)
+
                     # calculate error between optimized and observed pose
                     phi_error = abs(phi_ref - phi) if abs(phi_ref - phi)<300 else abs(abs(phi_ref - phi)-360)
                     theta_error = abs(theta_ref - theta) if abs(theta_ref - theta)<300 else abs(abs(theta_ref - theta)-360)
@@ -1,5 +1,5 @@
+import inspect
 import torch
-torch.autograd.set_detect_anomaly(True)
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
@@ -7,12 +7,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 
-from torchtyping import TensorType, patch_typeguard
-from typeguard import typechecked
+# annotations only: runtime shape checks are too slow for the inner loop
+from torchtyping import TensorType
 
-patch_typeguard()
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-@typechecked
 def nerf(points: TensorType["batch":..., 2]) -> TensorType["batch":...]:
     x = points[..., 0]
     y = points[..., 1]
@@ -35,10 +34,14 @@ class System:
     def __init__(self, start_state, end_state, steps):
         self.dt = 0.1
 
+        assert start_state.shape == (3,) and end_state.shape == (3,), "states are (x, y, angle)"
+        start_state = start_state.to(device)
+        end_state = end_state.to(device)
+
         self.start_state = start_state[None,:]
         self.end_state = end_state[None,:]
 
-        slider = torch.linspace(0, 1, steps)[1:-1, None]
+        slider = torch.linspace(0, 1, steps, device=device)[1:-1, None]
 
         states = (1-slider) * start_state + slider * end_state
         # self.states = torch.tensor(states, requires_grad=True)
@@ -47,7 +50,7 @@ class System:
         body = torch.stack( torch.meshgrid( torch.linspace(-0.5, 0.5, 10), 
                                             torch.linspace(-  1,   1, 10) ), dim=-1)
 
-        self.robot_body = body.reshape(-1, 2)
+        self.robot_body = body.reshape(-1, 2).to(device)
 
     def params(self):
         return [self.states]
@@ -71,7 +74,6 @@ class System:
         return torch.cat( [lin_vel, rot_vel], dim=-1 )
 
 
-    @typechecked
     def body_to_world(self, points: TensorType["batch", 2]) -> TensorType["states", "batch", 2]:
         states = self.get_states()
         pos = states[..., :2]
@@ -103,14 +105,13 @@ class System:
 
 
     @staticmethod
-    @typechecked
     def rot_matrix(angle: TensorType["batch":...]) -> TensorType["batch":..., 2, 2]:
-        rot_matrix = torch.zeros( angle.shape + (2,2) )
-        rot_matrix[:, 0,0] =  torch.cos(angle)
-        rot_matrix[:, 0,1] = -torch.sin(angle)
-        rot_matrix[:, 1,0] =  torch.sin(angle)
-        rot_matrix[:, 1,1] =  torch.cos(angle)
-        return rot_matrix
+        c = torch.cos(angle)
+        s = torch.sin(angle)
+        # no in-place writes so the compiled graph has no scatters
+        row0 = torch.stack( [c, -s], dim=-1)
+        row1 = torch.stack( [s,  c], dim=-1)
+        return torch.stack( [row0, row1], dim=-2)
 
     def plot(self, fig = None):
         if fig == None:
@@ -124,17 +125,17 @@ class System:
         plt.show()
 
     def plot_graph(self, ax):
-        states = self.get_states().detach().numpy()
+        states = self.get_states().detach().cpu().numpy()
         ax.plot(states[...,0], label="x")
         ax.plot(states[...,1], label="y")
         ax.plot(states[...,2], label="a")
-        actions = self.get_actions().detach().numpy() 
+        actions = self.get_actions().detach().cpu().numpy() 
         ax.plot(actions[...,0], label="dx")
         ax.plot(actions[...,1], label="dy")
         ax.plot(actions[...,2], label="da")
 
         ax_right = ax.twinx()
-        ax_right.plot(self.get_cost().detach().numpy(), label="cost")
+        ax_right.plot(self.get_cost().detach().cpu().numpy(), label="cost")
         ax.legend()
 
     def plot_map(self, ax, color = "g", show_cloud = True, alpha = 1):
@@ -146,13 +147,13 @@ class System:
 
         # PLOT PATH
         # S, 1, 2
-        pos = self.body_to_world( torch.zeros((1,2))).detach().numpy()
+        pos = self.body_to_world( torch.zeros((1,2), device=device)).detach().cpu().numpy()
         ax.plot( * pos.T , alpha = alpha)
 
         if show_cloud:
             # PLOTS BODY POINTS
             # S, P, 2
-            body_points = self.body_to_world(self.robot_body).detach().numpy()
+            body_points = self.body_to_world(self.robot_body).detach().cpu().numpy()
             for state_body in body_points:
                 # ax.plot( *state_body.T, color+".", ms=72./ax.figure.dpi, alpha = 0.5*alpha)
                 ax.plot( *state_body.T, color+".", ms=72./ax.figure.dpi, alpha = alpha)
@@ -175,8 +176,8 @@ class System:
         #                                     torch.linspace(-  1,   1, 10) ), dim=-1)
 
         #plot box
-        points = torch.tensor( [[-0.5, -1], [-0.5, 1], [0.5, 1], [0.5, -1]])
-        points_world_frame = self.body_to_world(points).detach().numpy()
+        points = torch.tensor( [[-0.5, -1], [-0.5, 1], [0.5, 1], [0.5, -1]], device=device)
+        points_world_frame = self.body_to_world(points).detach().cpu().numpy()
         for state_axis in points_world_frame:
             for i in range(4):
                 ax.plot(state_axis[[i,(i+1)%4], 0],
@@ -194,18 +195,40 @@ def main(option = "figure"):
 
     traj = System(start_state, end_state, steps)
 
-    opt = torch.optim.Adam(traj.params(), lr=0.05)
+    # states have a fixed shape, so on cuda the whole step is captured once and replayed
+    cuda_graph = device.type == "cuda"
+
+    # multi-tensor (torch._foreach_*) update instead of the per-parameter loop where available (torch >= 1.12)
+    adam_impl = {"foreach": True} if "foreach" in inspect.signature(torch.optim.Adam).parameters else {}
+    # capturable (torch >= 1.12) is only passed when it is needed
+    if cuda_graph:
+        adam_impl["capturable"] = True
+    opt = torch.optim.Adam(traj.params(), lr=0.05, **adam_impl)
+
+    # the cost is a chain of tiny ops, compile it once to cut the python/dispatch overhead
+    total_cost = torch.compile(traj.total_cost) if hasattr(torch, "compile") else traj.total_cost
+
+    # several Adam updates per step: one python iteration (and on cuda one graph replay) covers all of them
+    unroll = 10  # must divide the iterations that are plotted below
+
+    def step():
+        for _ in range(unroll):
+            opt.zero_grad(set_to_none=True)
+            loss = total_cost()
+            loss.backward()
+            opt.step()
+        return loss
 
     if option == "figure":
         fig = plt.figure(figsize=plt.figaspect(1.))
         ax_map = fig.add_subplot(1, 1, 1)
 
-    for it in range(1200):
-        opt.zero_grad()
-        loss = traj.total_cost()
-        print(it, loss)
-        loss.backward()
+    graph = None
+    if cuda_graph:
+        side_stream = torch.cuda.Stream()
 
+    for it in range(0, 1200, unroll):
+        # plots show the states before this iteration's step
         if option == "figure":
             if it ==   0: traj.plot_map(ax_map, color = "r",show_cloud = False,  alpha = 0.35)
             # if it == 100: traj.plot_map(ax_map, color = "y", alpha = 0.5)
@@ -221,8 +244,25 @@ def main(option = "figure"):
                 #need to make folder for this
                 fig.savefig( "piano_gif_testing/" + str(it//10) + ".png")
 
-
-        opt.step()
+        if not cuda_graph:
+            loss = step()
+        elif graph is not None:
+            graph.replay()
+        elif it < 3 * unroll:
+            # warmup on a side stream before capture
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                loss = step()
+            torch.cuda.current_stream().wait_stream(side_stream)
+        else:
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                loss = step()
+            graph.replay()
+
+        # printing syncs with the device, only do it every 100 updates so replays can queue up
+        if (it + unroll) % 100 == 0 or it == 0:
+            print(it + unroll - 1, loss.item())
 
     if option == "figure":
         plot_nerf(ax_map, nerf)